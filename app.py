@@ -1,54 +1,682 @@
+import asyncio
+import functools
+import hashlib
+import inspect
 import json
-import re
 from datetime import datetime
-from typing import Any, Dict
+from typing import Annotated, Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple
 
+import httpx
+import msgspec
+import numpy as np
+import openai
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+try:
+    import orjson
+except ImportError:
+    # Optional speedup; the stdlib json module is used otherwise.
+    orjson = None
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
-def extract_json(text: str) -> Dict[str, Any]:
-    """
-    Best-effort JSON extraction if the model accidentally wraps output with text.
+# Byte values the JSON object scanner cares about.
+OPEN_BRACE, CLOSE_BRACE, QUOTE, BACKSLASH = b'{}"\\'
+
+
+def find_json_object(text: str) -> bytes:
     """
-    text = text.strip()
-    if text.startswith("{") and text.endswith("}"):
-        return json.loads(text)
+    Return the first balanced {...} object in text using a single forward scan.
+    Braces inside JSON strings are ignored.
 
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if not m:
+    The scan runs over the UTF-8 bytes, which the JSON decoders accept directly;
+    multi-byte characters never contain ASCII bytes, so they cannot be mistaken
+    for braces or quotes.
+    """
+    data = text.encode("utf-8")
+    start = data.find(b"{")
+    if start == -1:
         raise ValueError("No JSON object found in model output.")
-    return json.loads(m.group(0))
+
+    depth = 0
+    in_string = False
+    escape = False
+    for offset, byte in enumerate(data[start:]):
+        if in_string:
+            if escape:
+                escape = False
+            elif byte == BACKSLASH:
+                escape = True
+            elif byte == QUOTE:
+                in_string = False
+        elif byte == QUOTE:
+            in_string = True
+        elif byte == OPEN_BRACE:
+            depth += 1
+        elif byte == CLOSE_BRACE:
+            depth -= 1
+            if depth == 0:
+                return data[start:start + offset + 1]
+    raise ValueError("Unterminated JSON object in model output.")
+
+
+def extract_json(text: str, schema: Optional[type] = None) -> Dict[str, Any]:
+    """
+    Parse the model output as JSON. JSON mode normally returns a bare object, so
+    the whole text is decoded first; only if that fails is the first object
+    scanned out of any surrounding text.
+    When a msgspec schema is given, the object is parsed and validated in one pass
+    (raising msgspec.ValidationError on mismatch) and returned as plain builtins.
+    """
+    def decode(data):
+        if schema is not None:
+            return msgspec.to_builtins(msgspec.json.decode(data, type=schema))
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    try:
+        return decode(text)
+    except msgspec.ValidationError:
+        # Well-formed JSON of the wrong shape; scanning would not help.
+        raise
+    except ValueError:
+        return decode(find_json_object(text))
+
+
+# Responses sampled above this temperature are not cached: a repeat click
+# should be free to produce a different variant.
+CACHE_MAX_TEMPERATURE = 0.3
+
+# Default sampling temperature for LLM calls; low enough that responses are cached.
+DEFAULT_TEMPERATURE = 0.2
+
+# Semantic cache: paraphrased inputs whose embeddings are this similar reuse
+# the earlier response.
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+
+# Transient API failures (rate limits, dropped connections, 5xx) on LLM calls are
+# retried with backoff before surfacing. The wrapped calls run with
+# max_retries=0 so these attempts are not multiplied by the SDK's own retries;
+# every other client call (files, batches) keeps the SDK's default retries.
+backoff = wait_exponential(multiplier=1, min=1, max=20)
+
+# Longest server-requested Retry-After wait honored; anything else falls back
+# to the exponential backoff.
+MAX_RETRY_AFTER = 60
+
+
+def wait_retry_after(retry_state) -> float:
+    """
+    Honor the server's Retry-After header when it is a number of seconds in
+    (0, MAX_RETRY_AFTER], else back off exponentially.
+    """
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        seconds = float(retry_after)
+    except (TypeError, ValueError):
+        return backoff(retry_state)
+    if 0 < seconds <= MAX_RETRY_AFTER:
+        return seconds
+    return backoff(retry_state)
+
+
+llm_retry = retry(
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+    ),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+
+
+@llm_retry
+def create_completion(client: OpenAI, **request: Any) -> Any:
+    return client.with_options(max_retries=0).chat.completions.create(**request)
+
+
+@llm_retry
+async def create_completion_async(client: AsyncOpenAI, **request: Any) -> Any:
+    return await client.with_options(max_retries=0).chat.completions.create(**request)
 
 
-def call_llm_json(client: OpenAI, model: str, instructions: str, user_input: str) -> Dict[str, Any]:
+@llm_retry
+def create_embedding(client: OpenAI, text: str) -> List[float]:
+    response = client.with_options(max_retries=0).embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+
+@llm_retry
+async def create_embedding_async(client: AsyncOpenAI, text: str) -> List[float]:
+    response = await client.with_options(max_retries=0).embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+
+def llm_cache_key(model: str, instructions: str, user_input: str, temperature: float) -> str:
+    return hashlib.sha256((model + instructions + user_input + str(temperature)).encode()).hexdigest()
+
+
+def normalize_embedding(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def embed_text(client: OpenAI, text: str) -> Optional[np.ndarray]:
+    """
+    Embed text for the semantic cache, memoized per session. Returns None when
+    the embedding call fails, so the semantic lookup is skipped instead of
+    failing the completion it only exists to save.
+    """
+    embeddings = st.session_state.setdefault("_embedding_cache", {})
+    if text not in embeddings:
+        try:
+            embeddings[text] = normalize_embedding(create_embedding(client, text))
+        except openai.APIError:
+            return None
+    return embeddings[text]
+
+
+async def embed_text_async(client: AsyncOpenAI, text: str) -> Optional[np.ndarray]:
+    embeddings = st.session_state.setdefault("_embedding_cache", {})
+    if text not in embeddings:
+        try:
+            embeddings[text] = normalize_embedding(await create_embedding_async(client, text))
+        except openai.APIError:
+            return None
+    return embeddings[text]
+
+
+def semantic_cache_lookup(namespace: str, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+    entry = st.session_state.setdefault("_semantic_cache", {}).get(namespace)
+    if entry is None:
+        return None
+    similarities = entry["vectors"] @ vector
+    best = int(np.argmax(similarities))
+    if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+        return entry["responses"][best]
+    return None
+
+
+def semantic_cache_store(namespace: str, vector: np.ndarray, response: Dict[str, Any]) -> None:
+    cache = st.session_state.setdefault("_semantic_cache", {})
+    entry = cache.setdefault(namespace, {"vectors": np.empty((0, vector.shape[0]), dtype=np.float32), "responses": []})
+    entry["vectors"] = np.vstack([entry["vectors"], vector])
+    entry["responses"].append(response)
+
+
+def cache_lookup(
+    key: str, semantic: Optional[Tuple[str, np.ndarray]] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Return a cached response for the exact key, or for a near-duplicate
+    (namespace, vector) when semantic is given. Semantic hits are promoted to
+    the exact cache.
+    """
+    cache = st.session_state.setdefault("_llm_cache", {})
+    if key in cache:
+        return cache[key]
+    if semantic is not None:
+        hit = semantic_cache_lookup(*semantic)
+        if hit is not None:
+            cache[key] = hit
+            return hit
+    return None
+
+
+def cache_store(
+    key: str, result: Dict[str, Any], semantic: Optional[Tuple[str, np.ndarray]] = None
+) -> None:
+    st.session_state.setdefault("_llm_cache", {})[key] = result
+    if semantic is not None:
+        semantic_cache_store(*semantic, result)
+
+
+def cached_llm_call(func: Callable) -> Callable:
+    """
+    Memoize an LLM call in session state, keyed on the exact request content.
+    Works for both the sync and the async call helpers.
+
+    Callers may also pass semantic_key=(namespace, text): the text is embedded and a
+    near-duplicate earlier request in the same namespace reuses its response. Any
+    input that must match exactly (e.g. the brand name) belongs in the namespace.
+    If the embedding call fails, only the exact cache is used.
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(client, model, instructions, user_input, temperature=DEFAULT_TEMPERATURE, semantic_key=None, **options):
+            if temperature > CACHE_MAX_TEMPERATURE:
+                return await func(client, model, instructions, user_input, temperature, **options)
+            key = llm_cache_key(model, instructions, user_input, temperature)
+            hit = cache_lookup(key)
+            if hit is not None:
+                return hit
+
+            semantic = None
+            if semantic_key is not None:
+                namespace_name, text = semantic_key
+                vector = await embed_text_async(client, text)
+                if vector is not None:
+                    namespace = llm_cache_key(model, instructions, namespace_name, temperature)
+                    semantic = (namespace, vector)
+                    hit = cache_lookup(key, semantic)
+                    if hit is not None:
+                        return hit
+
+            result = await func(client, model, instructions, user_input, temperature, **options)
+            cache_store(key, result, semantic)
+            return result
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(client, model, instructions, user_input, temperature=DEFAULT_TEMPERATURE, semantic_key=None, **options):
+        if temperature > CACHE_MAX_TEMPERATURE:
+            return func(client, model, instructions, user_input, temperature, **options)
+        key = llm_cache_key(model, instructions, user_input, temperature)
+        hit = cache_lookup(key)
+        if hit is not None:
+            return hit
+
+        semantic = None
+        if semantic_key is not None:
+            namespace_name, text = semantic_key
+            vector = embed_text(client, text)
+            if vector is not None:
+                namespace = llm_cache_key(model, instructions, namespace_name, temperature)
+                semantic = (namespace, vector)
+                hit = cache_lookup(key, semantic)
+                if hit is not None:
+                    return hit
+
+        result = func(client, model, instructions, user_input, temperature, **options)
+        cache_store(key, result, semantic)
+        return result
+
+    return wrapper
+
+
+# Extra attempts allowed when the model's JSON does not match the schema.
+MAX_SCHEMA_RETRIES = 2
+
+
+def schema_retry_messages(content: str, error: msgspec.ValidationError) -> List[Dict[str, str]]:
+    return [
+        {"role": "assistant", "content": content},
+        {"role": "user", "content": f"That JSON did not match the schema: {error}. Return the corrected JSON only."},
+    ]
+
+
+def stream_deltas(response) -> Iterator[str]:
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def response_format_for(json_schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if json_schema is None:
+        return {"type": "json_object"}
+    return {"type": "json_schema", "json_schema": json_schema}
+
+
+def message_content(content: Optional[str], refusal: Optional[str] = None) -> str:
+    """
+    Return a message's content. Structured outputs leave content None when the
+    model refuses, so that case raises ValueError instead of parsing None.
+    """
+    if content is None:
+        raise ValueError(f"Model refused the request: {refusal or 'no content returned'}")
+    return content
+
+
+def complete_chat(
+    client: OpenAI,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    stream: bool = False,
+    json_schema: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Run one JSON chat completion and return the raw message content.
+    With stream=True the tokens are rendered live and cleared once complete.
+    A json_schema ({"name", "schema", "strict"}) switches to structured outputs.
+    """
+    response = create_completion(
+        client,
+        model=model,
+        messages=messages,
+        response_format=response_format_for(json_schema),
+        temperature=temperature,
+        stream=stream,
+    )
+    if not stream:
+        message = response.choices[0].message
+        return message_content(message.content, getattr(message, "refusal", None))
+
+    placeholder = st.empty()
+    with placeholder.container():
+        content = st.write_stream(stream_deltas(response))
+    placeholder.empty()
+    return content
+
+
+@cached_llm_call
+def call_llm_json(
+    client: OpenAI,
+    model: str,
+    instructions: str,
+    user_input: str,
+    temperature: float = DEFAULT_TEMPERATURE,
+    schema: Optional[type] = None,
+    stream: bool = False,
+    json_schema: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
     """
     Call OpenAI API with proper chat completions endpoint and JSON mode.
+    Output that fails schema validation is sent back to the model for correction.
     """
+    messages = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": user_input}
+    ]
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": user_input}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.7,
-        )
-        content = response.choices[0].message.content
-        return extract_json(content)
+        for attempt in range(MAX_SCHEMA_RETRIES + 1):
+            content = complete_chat(client, model, messages, temperature, stream, json_schema)
+            try:
+                return extract_json(content, schema)
+            except msgspec.ValidationError as e:
+                if attempt == MAX_SCHEMA_RETRIES:
+                    raise
+                messages = messages + schema_retry_messages(content, e)
     except Exception as e:
         st.error(f"API Error: {str(e)}")
         raise
 
 
+@cached_llm_call
+async def call_llm_json_async(
+    client: AsyncOpenAI,
+    model: str,
+    instructions: str,
+    user_input: str,
+    temperature: float = DEFAULT_TEMPERATURE,
+    schema: Optional[type] = None,
+    json_schema: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Async variant of call_llm_json so independent prompts can run concurrently.
+    """
+    messages = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": user_input}
+    ]
+    try:
+        for attempt in range(MAX_SCHEMA_RETRIES + 1):
+            response = await create_completion_async(
+                client,
+                model=model,
+                messages=messages,
+                response_format=response_format_for(json_schema),
+                temperature=temperature,
+            )
+            message = response.choices[0].message
+            content = message_content(message.content, getattr(message, "refusal", None))
+            try:
+                return extract_json(content, schema)
+            except msgspec.ValidationError as e:
+                if attempt == MAX_SCHEMA_RETRIES:
+                    raise
+                messages = messages + schema_retry_messages(content, e)
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        raise
+
+
+def generate_assets(
+    client: OpenAI,
+    model: str,
+    product_description: str,
+    voice_card_json: str,
+    brand_context: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Generate every asset section concurrently and merge the results into one dict.
+    """
+    # Sections written against a different voice card must not be reused.
+    voice_card_hash = hashlib.sha256(voice_card_json.encode()).hexdigest()
+
+    async def gather_sections() -> Dict[str, Any]:
+        async with AsyncOpenAI(api_key=client.api_key) as async_client:
+            results = await asyncio.gather(*(
+                call_llm_json_async(
+                    client=async_client,
+                    model=model,
+                    instructions=ASSETS_INSTRUCTIONS,
+                    user_input=ASSETS_USER_TEMPLATE.format(
+                        section=section,
+                        product_description=product_description,
+                        voice_card_json=voice_card_json,
+                        schema=schema,
+                    ),
+                    temperature=DEFAULT_TEMPERATURE,
+                    semantic_key=(
+                        (f"assets.{section}\n{brand_context}\n{voice_card_hash}", product_description)
+                        if brand_context is not None else None
+                    ),
+                    schema=ASSETS_SECTION_TYPES[section],
+                )
+                for section, schema in ASSETS_SECTION_SCHEMAS.items()
+            ))
+        return {section: result[section] for section, result in zip(ASSETS_SECTION_SCHEMAS, results)}
+
+    return asyncio.run(gather_sections())
+
+
+def enumerate_assets(assets: Dict[str, Any]) -> List[Tuple[str, str, Any]]:
+    """
+    Split assets into independently auditable (asset_id, channel, content) units.
+    """
+    items = [("campaign_core", "campaign", assets["campaign_core"])]
+    for name, email in assets["email_sequence"].items():
+        items.append((f"email_sequence.{name}", "email", email))
+    for channel, posts in assets["social"].items():
+        for i, post in enumerate(posts):
+            items.append((f"social.{channel}.{i}", channel, post))
+    items.append(("web_landing_page", "web", assets["web_landing_page"]))
+    return items
+
+
+def flatten_assets_for_audit(assets: Any, prefix: str = "") -> str:
+    """
+    Render assets as compact "asset_id: ...\\ntext: ..." blocks for the audit prompt,
+    dropping JSON indentation and structural keys. Lists of strings (hashtags,
+    key messages) are joined into a single text line.
+    """
+    if isinstance(assets, dict):
+        return "".join(
+            flatten_assets_for_audit(value, f"{prefix}.{key}" if prefix else key) for key, value in assets.items()
+        )
+    if isinstance(assets, list):
+        if all(isinstance(item, str) for item in assets):
+            return f"asset_id: {prefix}\ntext: {', '.join(assets)}\n\n"
+        return "".join(flatten_assets_for_audit(item, f"{prefix}.{i}") for i, item in enumerate(assets))
+    return f"asset_id: {prefix}\ntext: {assets}\n\n"
+
+
+def audit_user_input(voice_card_json: str, assets: Dict[str, Any], asset_id: str, channel: str, content: Any) -> str:
+    return AUDIT_USER_TEMPLATE.format(
+        voice_card_json=voice_card_json,
+        campaign_core_text=flatten_assets_for_audit(assets["campaign_core"], "campaign_core"),
+        asset_id=asset_id,
+        channel=channel,
+        asset_text=flatten_assets_for_audit(content, asset_id),
+    )
+
+
+def build_audit_report(scored_items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Aggregate per-asset scores into the audit report; the overall numbers are
+    computed here rather than asked of the model.
+    """
+    drift = sorted((item for item in scored_items if item["score"] <= AUDIT_DRIFT_SCORE), key=lambda item: item["score"])
+    average = sum(item["score"] for item in scored_items) / len(scored_items) if scored_items else 0
+    return {
+        "overall": {
+            "average_score": round(average, 2),
+            "top_drift_themes": [item["why"] for item in drift[:3]],
+            "global_fixes": [item["fix_suggestion"] for item in drift[:3]],
+        },
+        "items": scored_items,
+    }
+
+
+def audit_assets(
+    client: OpenAI, model: str, voice_card_json: str, assets: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Score every asset with its own concurrent call and aggregate the results.
+    Returns (report, skipped): items the model refused or answered with invalid
+    output are left out of the report and counted in skipped.
+    """
+    items = enumerate_assets(assets)
+
+    async def score_items() -> List[Optional[Dict[str, Any]]]:
+        semaphore = asyncio.Semaphore(AUDIT_CONCURRENCY)
+        async with AsyncOpenAI(api_key=client.api_key) as async_client:
+            async def score(asset_id: str, channel: str, content: Any) -> Optional[Dict[str, Any]]:
+                async with semaphore:
+                    try:
+                        return await call_llm_json_async(
+                            client=async_client,
+                            model=model,
+                            instructions=AUDIT_INSTRUCTIONS,
+                            user_input=audit_user_input(voice_card_json, assets, asset_id, channel, content),
+                            temperature=AUDIT_TEMPERATURE,
+                            schema=AuditScore,
+                            json_schema=AUDIT_JSON_SCHEMA,
+                        )
+                    except ValueError:
+                        return None
+
+            return await asyncio.gather(*(score(*item) for item in items))
+
+    scores = asyncio.run(score_items())
+    scored_items = [
+        {"asset_id": asset_id, "channel": channel, **score}
+        for (asset_id, channel, _), score in zip(items, scores)
+        if score is not None
+    ]
+    if not scored_items:
+        raise ValueError("No audit item could be scored.")
+    return build_audit_report(scored_items), len(items) - len(scored_items)
+
+
+def submit_audit_batch(client: OpenAI, model: str, voice_card_json: str, assets: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Queue the per-asset audit on the OpenAI Batch API (half price, results within 24h).
+    Returns the pending batch record to keep in session state.
+    """
+    items = enumerate_assets(assets)
+    requests = [
+        {
+            "custom_id": asset_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": AUDIT_INSTRUCTIONS},
+                    {"role": "user", "content": audit_user_input(voice_card_json, assets, asset_id, channel, content)},
+                ],
+                "response_format": response_format_for(AUDIT_JSON_SCHEMA),
+                "temperature": AUDIT_TEMPERATURE,
+            },
+        }
+        for asset_id, channel, content in items
+    ]
+    batch_input = "\n".join(json.dumps(request, ensure_ascii=False) for request in requests)
+    batch_file = client.files.create(file=("audit_batch.jsonl", batch_input.encode()), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return {"id": batch.id, "channels": {asset_id: channel for asset_id, channel, _ in items}}
+
+
+def collect_audit_batch(client: OpenAI, pending: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]], int]:
+    """
+    Poll a queued audit batch. Returns (status, report, skipped); report is None
+    until completed. Items whose request failed, was refused or returned invalid
+    output are left out of the report and counted in skipped. A completed batch with no usable
+    item is reported as "failed".
+    """
+    batch = client.batches.retrieve(pending["id"])
+    if batch.status != "completed":
+        return batch.status, None, 0
+
+    scored_items = []
+    output = client.files.content(batch.output_file_id).text if batch.output_file_id else ""
+    for line in output.splitlines():
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            continue
+        message = response["body"]["choices"][0]["message"]
+        try:
+            score = extract_json(message_content(message["content"], message.get("refusal")), AuditScore)
+        except ValueError:
+            continue
+        asset_id = result["custom_id"]
+        scored_items.append({"asset_id": asset_id, "channel": pending["channels"][asset_id], **score})
+
+    skipped = len(pending["channels"]) - len(scored_items)
+    if not scored_items:
+        return "failed", None, skipped
+
+    order = list(pending["channels"])
+    scored_items.sort(key=lambda item: order.index(item["asset_id"]))
+    return batch.status, build_audit_report(scored_items), skipped
+
+
 def pretty_json(obj: Dict[str, Any]) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
     return json.dumps(obj, indent=2, ensure_ascii=False)
 
 
+def compact_json(obj: Dict[str, Any]) -> str:
+    """
+    Serialize without indentation, for JSON embedded in prompts.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+@st.cache_resource
+def get_openai_client(api_key: str) -> OpenAI:
+    """
+    Build the OpenAI client once per API key so its HTTP/2 keep-alive
+    connections survive Streamlit reruns. DefaultHttpxClient keeps the SDK's
+    default timeout and redirect settings that a bare httpx.Client would drop.
+    """
+    return OpenAI(
+        api_key=api_key,
+        http_client=openai.DefaultHttpxClient(
+            http2=True, limits=httpx.Limits(max_keepalive_connections=20)
+        ),
+    )
+
+
 # -----------------------------
 # Prompts
 # -----------------------------
@@ -62,14 +690,10 @@ Hard rules:
 - You MUST return valid JSON that matches the requested schema.
 """
 
-VOICE_CARD_USER_TEMPLATE = """Create a Brand Voice Card for the following.
-
-Brand name: {brand_name}
-Target audience: {audience}
-Primary objective: {objective}
-Product description (source of truth): {product_description}
-
-Output JSON schema:
+# User templates put the content shared between calls first and what varies
+# last, so calls share the longest possible prompt prefix (OpenAI caches
+# matching prefixes automatically).
+VOICE_CARD_USER_TEMPLATE = """Create a Brand Voice Card using this output JSON schema:
 {{
   "brand": {{
     "name": "...",
@@ -96,6 +720,11 @@ Output JSON schema:
     "..."
   ]
 }}
+
+Brand name: {brand_name}
+Target audience: {audience}
+Primary objective: {objective}
+Product description (source of truth): {product_description}
 """
 
 ASSETS_INSTRUCTIONS = """You are a performance marketer and brand copy lead.
@@ -109,92 +738,105 @@ Hard rules:
 - You MUST return valid JSON that matches the requested schema.
 """
 
-ASSETS_USER_TEMPLATE = """Generate a multi-channel marketing plan and copy.
+# The four section calls run together, so the content they share (voice card,
+# product description) leads and the section name + schema come last.
+ASSETS_USER_TEMPLATE = """Inputs:
+Brand Voice Card (must follow):
+{voice_card_json}
 
-Inputs:
 Product description (source of truth): {product_description}
 
-Brand Voice Card (must follow):
-{voice_card_json}
+Generate the "{section}" section of a multi-channel marketing plan and copy.
 
 Output JSON schema:
-{{
-  "campaign_core": {{
+{schema}
+"""
+
+# Each section is requested independently so the calls can run concurrently.
+ASSETS_SECTION_SCHEMAS = {
+    "campaign_core": """{
+  "campaign_core": {
     "big_idea": "...",
     "key_messages": ["...", "...", "..."],
     "primary_cta": "..."
-  }},
-  "email_sequence": {{
-    "email_1": {{
+  }
+}""",
+    "email_sequence": """{
+  "email_sequence": {
+    "email_1": {
       "goal": "...",
       "subject": "...",
       "preheader": "...",
       "body": "...",
       "cta": "..."
-    }},
-    "email_2": {{
+    },
+    "email_2": {
       "goal": "...",
       "subject": "...",
       "preheader": "...",
       "body": "...",
       "cta": "..."
-    }},
-    "email_3": {{
+    },
+    "email_3": {
       "goal": "...",
       "subject": "...",
       "preheader": "...",
       "body": "...",
       "cta": "..."
-    }}
-  }},
-  "social": {{
+    }
+  }
+}""",
+    "social": """{
+  "social": {
     "linkedin": [
-      {{
+      {
         "post": "...",
         "creative_direction": "...",
         "hashtags": ["...","..."]
-      }}
+      }
     ],
     "instagram": [
-      {{
+      {
         "caption": "...",
         "reel_script": "...",
         "on_screen_text": ["...","..."],
         "hashtags": ["...","..."]
-      }}
+      }
     ],
     "x": [
-      {{
+      {
         "post": "..."
-      }}
+      }
     ]
-  }},
-  "web_landing_page": {{
+  }
+}""",
+    "web_landing_page": """{
+  "web_landing_page": {
     "hero_headline": "...",
     "hero_subhead": "...",
     "sections": [
-      {{
+      {
         "title": "...",
         "copy": "..."
-      }}
+      }
     ],
     "faq": [
-      {{
+      {
         "q": "...",
         "a": "..."
-      }}
+      }
     ],
     "meta_title": "...",
     "meta_description": "..."
-  }}
-}}
-"""
+  }
+}""",
+}
 
 AUDIT_INSTRUCTIONS = """You are a meticulous brand QA reviewer.
 Return VALID JSON ONLY. No markdown. No extra commentary.
 
 Task:
-Score each asset for voice consistency against the Voice Card and message consistency across channels.
+Score one asset for voice consistency against the Voice Card and message consistency with the campaign core.
 
 Scoring:
 - score from 1 to 5 (5 = perfect alignment)
@@ -203,32 +845,161 @@ Scoring:
 - You MUST return valid JSON that matches the requested schema.
 """
 
-AUDIT_USER_TEMPLATE = """Audit the following assets.
+AUDIT_USER_TEMPLATE = """Audit the asset below. Return JSON schema:
+{{
+  "score": 1,
+  "why": "...",
+  "fix_suggestion": "..."
+}}
 
 Voice Card:
 {voice_card_json}
 
-Assets:
-{assets_json}
+Campaign core (messages every channel should carry):
+{campaign_core_text}
+Asset ID: {asset_id}
+Channel: {channel}
+Asset fields:
+{asset_text}"""
 
-Return JSON schema:
-{{
-  "overall": {{
-    "average_score": 0,
-    "top_drift_themes": ["...","..."],
-    "global_fixes": ["...","..."]
-  }},
-  "items": [
-    {{
-      "asset_id": "email_sequence.email_1.body",
-      "channel": "email",
-      "score": 1,
-      "why": "...",
-      "fix_suggestion": "..."
-    }}
-  ]
-}}
-"""
+# Structured-outputs schema for one audit item: constrained decoding guarantees the shape.
+AUDIT_JSON_SCHEMA = {
+    "name": "audit_item",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "score": {"type": "integer"},
+            "why": {"type": "string"},
+            "fix_suggestion": {"type": "string"},
+        },
+        "required": ["score", "why", "fix_suggestion"],
+        "additionalProperties": False,
+    },
+}
+
+# Max per-asset audit calls in flight at once (real-time mode).
+AUDIT_CONCURRENCY = 10
+
+# Scoring should be as repeatable as the model allows.
+AUDIT_TEMPERATURE = 0
+
+# Items scoring at or below this are reported as drift in the overall summary.
+AUDIT_DRIFT_SCORE = 3
+
+
+# -----------------------------
+# Output schemas (mirror the JSON schemas in the prompts)
+# -----------------------------
+class Brand(msgspec.Struct):
+    name: str
+    positioning_one_liner: str
+    audience: str
+    objective: str
+
+
+class Voice(msgspec.Struct):
+    tone_traits: List[str]
+    formality: Literal["low", "medium", "high"]
+    sentence_style: Literal["short", "mixed", "long"]
+    humor_level: Literal["none", "light", "playful"]
+    emoji_policy: Literal["none", "sparingly", "allowed"]
+    pov: Literal["we", "you", "third_person"]
+
+
+class Lexicon(msgspec.Struct):
+    use: List[str]
+    avoid: List[str]
+
+
+class VoiceCard(msgspec.Struct):
+    brand: Brand
+    voice: Voice
+    lexicon: Lexicon
+    style_rules: List[str]
+    compliance_guardrails: List[str]
+
+
+class CampaignCore(msgspec.Struct):
+    big_idea: str
+    key_messages: List[str]
+    primary_cta: str
+
+
+class Email(msgspec.Struct):
+    goal: str
+    subject: str
+    preheader: str
+    body: str
+    cta: str
+
+
+class EmailSequence(msgspec.Struct):
+    email_1: Email
+    email_2: Email
+    email_3: Email
+
+
+class LinkedInPost(msgspec.Struct):
+    post: str
+    creative_direction: str
+    hashtags: List[str]
+
+
+class InstagramPost(msgspec.Struct):
+    caption: str
+    reel_script: str
+    on_screen_text: List[str]
+    hashtags: List[str]
+
+
+class XPost(msgspec.Struct):
+    post: str
+
+
+class Social(msgspec.Struct):
+    linkedin: List[LinkedInPost]
+    instagram: List[InstagramPost]
+    x: List[XPost]
+
+
+class LandingSection(msgspec.Struct):
+    title: str
+    copy: str
+
+
+class FaqItem(msgspec.Struct):
+    q: str
+    a: str
+
+
+class WebLandingPage(msgspec.Struct):
+    hero_headline: str
+    hero_subhead: str
+    sections: List[LandingSection]
+    faq: List[FaqItem]
+    meta_title: str
+    meta_description: str
+
+
+class Assets(msgspec.Struct):
+    campaign_core: CampaignCore
+    email_sequence: EmailSequence
+    social: Social
+    web_landing_page: WebLandingPage
+
+
+# Each asset section call returns {"<section>": {...}}.
+ASSETS_SECTION_TYPES = {
+    name: msgspec.defstruct(f"{name}_response", [(name, field_type)])
+    for name, field_type in Assets.__annotations__.items()
+}
+
+
+class AuditScore(msgspec.Struct):
+    score: Annotated[int, msgspec.Meta(ge=1, le=5)]
+    why: str
+    fix_suggestion: str
 
 
 # -----------------------------
@@ -243,6 +1014,7 @@ with st.sidebar:
     audience = st.text_input("Target audience", "Busy professionals who value quality and convenience")
     objective = st.text_input("Primary objective", "Drive qualified leads and trials")
     model = st.text_input("Model", "gpt-4o")
+    audit_model = st.text_input("Audit model", "gpt-4o-mini")
 
     st.caption("Tip: store OPENAI_API_KEY in Streamlit secrets for deployment.")
     st.divider()
@@ -269,66 +1041,126 @@ if not api_key:
     if api_key:
         st.session_state["OPENAI_API_KEY"] = api_key
 
-client = OpenAI(api_key=api_key) if api_key else None
+client = get_openai_client(api_key) if api_key else None
 
-col_a, col_b = st.columns([1, 1])
+col_a, col_b, col_c = st.columns([1, 1, 1])
 
 with col_a:
     generate = st.button("🚀 Generate Voice Card + Assets", type="primary", disabled=not bool(client))
 with col_b:
     run_audit = st.button("🔍 Run Consistency Audit", disabled=not bool(client))
+with col_c:
+    queue_audit = st.button("📦 Queue Audit Batch", disabled=not bool(client))
 
 if generate and client:
-    try:
-        with st.spinner("Generating Brand Voice Card..."): 
-            voice_card = call_llm_json(
-                client=client,
-                model=model,
-                instructions=VOICE_CARD_INSTRUCTIONS,
-                user_input=VOICE_CARD_USER_TEMPLATE.format(
-                    brand_name=brand_name,
-                    audience=audience,
-                    objective=objective,
-                    product_description=product_description,
-                ),
-            )
-        st.session_state["voice_card"] = voice_card
-        st.success("✅ Voice Card generated!")
+    # The semantic cache matches these fields exactly and only tolerates
+    # paraphrases of the product description.
+    brand_context = "\n".join([brand_name, audience, objective])
+    input_hash = hashlib.blake2b(
+        "\n".join([brand_context, product_description, model]).encode(), digest_size=16
+    ).hexdigest()
+    if st.session_state.get("_last_gen_hash") == input_hash and "assets" in st.session_state:
+        st.info("Inputs unchanged; reusing the current generation.")
+    else:
+        try:
+            with st.spinner("Generating Brand Voice Card..."): 
+                voice_card = call_llm_json(
+                    client=client,
+                    model=model,
+                    instructions=VOICE_CARD_INSTRUCTIONS,
+                    user_input=VOICE_CARD_USER_TEMPLATE.format(
+                        brand_name=brand_name,
+                        audience=audience,
+                        objective=objective,
+                        product_description=product_description,
+                    ),
+                    temperature=DEFAULT_TEMPERATURE,
+                    semantic_key=(f"voice_card\n{brand_context}", product_description),
+                    schema=VoiceCard,
+                    stream=True,
+                )
+            voice_card_json = pretty_json(voice_card)
+            st.success("✅ Voice Card generated!")
 
-        with st.spinner("Generating multi-channel assets..."):
-            assets = call_llm_json(
-                client=client,
-                model=model,
-                instructions=ASSETS_INSTRUCTIONS,
-                user_input=ASSETS_USER_TEMPLATE.format(
+            with st.spinner("Generating multi-channel assets..."):
+                assets = generate_assets(
+                    client=client,
+                    model=model,
                     product_description=product_description,
-                    voice_card_json=pretty_json(voice_card),
-                ),
-            )
-        st.session_state["assets"] = assets
-        st.success("✅ Assets generated!")
-    except Exception as e:
-        st.error(f"Generation failed: {str(e)}")
+                    voice_card_json=voice_card_json,
+                    brand_context=brand_context,
+                )
+
+            # Save the voice card and assets together, only once both succeeded, so
+            # session state never pairs a new voice card with old assets (which the
+            # unchanged-inputs check above would then keep showing).
+            st.session_state["voice_card"] = voice_card
+            st.session_state["voice_card_str"] = voice_card_json
+            # The export only needs the per-section strings, not the whole dict pretty-printed.
+            st.session_state["assets"] = assets
+            st.session_state["assets_section_strs"] = {
+                section: pretty_json(assets[section]) for section in ASSETS_SECTION_SCHEMAS
+            }
+            st.session_state["_last_gen_hash"] = input_hash
+            # A batch queued for the previous assets must not land as their audit.
+            st.session_state.pop("_audit_batch", None)
+            st.session_state["_generated_at"] = datetime.now()
+            st.success("✅ Assets generated!")
+        except Exception as e:
+            st.error(f"Generation failed: {str(e)}")
 
-if run_audit and client:
+if (run_audit or queue_audit) and client:
     if "voice_card" not in st.session_state or "assets" not in st.session_state:
         st.warning("⚠️ Generate the Voice Card + Assets first.")
-    else:
+    elif run_audit:
         try:
             with st.spinner("Auditing consistency..."):
-                audit = call_llm_json(
+                audit, skipped = audit_assets(
                     client=client,
-                    model=model,
-                    instructions=AUDIT_INSTRUCTIONS,
-                    user_input=AUDIT_USER_TEMPLATE.format(
-                        voice_card_json=pretty_json(st.session_state["voice_card"]),
-                        assets_json=pretty_json(st.session_state["assets"]),
-                    ),
+                    model=audit_model,
+                    # Every per-asset prompt repeats the voice card; indentation only costs tokens.
+                    voice_card_json=compact_json(st.session_state["voice_card"]),
+                    assets=st.session_state["assets"],
                 )
+            # Serialized once here so reruns reuse the string for the export.
             st.session_state["audit"] = audit
+            st.session_state["audit_str"] = pretty_json(audit)
             st.success("✅ Audit complete!")
+            if skipped:
+                st.warning(f"⚠️ {skipped} of {skipped + len(audit['items'])} audit items failed and are not in the report.")
         except Exception as e:
             st.error(f"Audit failed: {str(e)}")
+    else:
+        try:
+            st.session_state["_audit_batch"] = submit_audit_batch(
+                client=client,
+                model=audit_model,
+                voice_card_json=compact_json(st.session_state["voice_card"]),
+                assets=st.session_state["assets"],
+            )
+        except Exception as e:
+            st.error(f"Queueing audit batch failed: {str(e)}")
+
+if "_audit_batch" in st.session_state and client:
+    pending = st.session_state["_audit_batch"]
+    st.info(f"📦 Audit batch `{pending['id']}` queued. Results usually arrive within minutes (up to 24h).")
+    if st.button("🔄 Check audit batch"):
+        try:
+            status, audit, skipped = collect_audit_batch(client, pending)
+            if audit is not None:
+                st.session_state["audit"] = audit
+                st.session_state["audit_str"] = pretty_json(audit)
+                del st.session_state["_audit_batch"]
+                st.success("✅ Audit batch complete!")
+                if skipped:
+                    st.warning(f"⚠️ {skipped} of {len(pending['channels'])} audit items failed and are not in the report.")
+            elif status in ("failed", "expired", "cancelled"):
+                del st.session_state["_audit_batch"]
+                st.error(f"Audit batch {status}; no items could be scored (see the batch error file for details).")
+            else:
+                st.write(f"Batch status: **{status}**")
+        except Exception as e:
+            st.error(f"Checking audit batch failed: {str(e)}")
 
 # Display outputs
 tabs = st.tabs(["📋 Brand Voice Card", "📝 Assets", "🔍 Consistency Audit", "📥 Export"])
@@ -336,14 +1168,14 @@ tabs = st.tabs(["📋 Brand Voice Card", "📝 Assets", "🔍 Consistency Audit"
 with tabs[0]:
     st.subheader("Brand Voice Card")
     if "voice_card" in st.session_state:
-        st.code(pretty_json(st.session_state["voice_card"]), language="json")
+        st.json(st.session_state["voice_card"], expanded=False)
     else:
         st.info("👆 Click **Generate Voice Card + Assets** to begin.")
 
 with tabs[1]:
     st.subheader("Multi-channel Assets")
     if "assets" in st.session_state:
-        st.code(pretty_json(st.session_state["assets"]), language="json")
+        st.json(st.session_state["assets"], expanded=False)
     else:
         st.info("👆 Click **Generate Voice Card + Assets** to begin.")
 
@@ -353,17 +1185,16 @@ with tabs[2]:
         audit_data = st.session_state["audit"]
         
         # Show overall score
-        if "overall" in audit_data:
-            col1, col2 = st.columns(2)
-            with col1:
-                st.metric("Average Score", f"{audit_data['overall'].get('average_score', 0)}/5")
-            with col2:
-                st.write("**Top Drift Themes:**")
-                for theme in audit_data['overall'].get('top_drift_themes', []):
-                    st.write(f"- {theme}")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Average Score", f"{audit_data['overall']['average_score']}/5")
+        with col2:
+            st.write("**Top Drift Themes:**")
+            for theme in audit_data['overall']['top_drift_themes']:
+                st.write(f"- {theme}")
         
         st.divider()
-        st.code(pretty_json(audit_data), language="json")
+        st.json(audit_data, expanded=False)
     else:
         st.info("👆 Click **Run Consistency Audit** after generation.")
 
@@ -371,55 +1202,44 @@ with tabs[3]:
     st.subheader("Export Campaign")
     
     if "voice_card" in st.session_state and "assets" in st.session_state:
-        # Build complete markdown export
-        export_md = f"""# Brand Voice Card
-Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-
-## Brand Information
-- **Name:** {st.session_state["voice_card"].get("brand", {}).get("name", "N/A")}
-- **Audience:** {st.session_state["voice_card"].get("brand", {}).get("audience", "N/A")}
-- **Objective:** {st.session_state["voice_card"].get("brand", {}).get("objective", "N/A")}
-
-## Voice Card (JSON)
-```json
-{pretty_json(st.session_state["voice_card"])}
-```
-
----
-
-# Multi-Channel Assets
-
-## Campaign Core
-```json
-{pretty_json(st.session_state["assets"].get("campaign_core", {}))}
-```
-
-## Email Sequence
-```json
-{pretty_json(st.session_state["assets"].get("email_sequence", {}))}
-```
-
-## Social Media
-```json
-{pretty_json(st.session_state["assets"].get("social", {}))}
-```
-
-## Landing Page
-```json
-{pretty_json(st.session_state["assets"].get("web_landing_page", {}))}
-```
-"""
-
-        if "audit" in st.session_state:
-            export_md += f"""
+        # Rebuild the markdown only when the underlying results change; the
+        # sources are kept (not just their ids) so identity checks stay valid.
+        export_sources = (
+            st.session_state["voice_card"],
+            st.session_state["assets"],
+            st.session_state.get("audit"),
+        )
+        cached_sources = st.session_state.get("_export_sources", (None, None, None))
+        if not all(new is old for new, old in zip(export_sources, cached_sources)):
+            # Build complete markdown export
+            voice_card = st.session_state["voice_card"]
+            section_strs = st.session_state["assets_section_strs"]
+            parts = [
+                "# Brand Voice Card\n",
+                f"Generated: {st.session_state['_generated_at'].strftime('%Y-%m-%d %H:%M:%S')}\n\n",
+                "## Brand Information\n",
+                f"- **Name:** {voice_card['brand']['name']}\n",
+                f"- **Audience:** {voice_card['brand']['audience']}\n",
+                f"- **Objective:** {voice_card['brand']['objective']}\n\n",
+                "## Voice Card (JSON)\n```json\n",
+                st.session_state["voice_card_str"],
+                "\n```\n\n---\n\n# Multi-Channel Assets\n",
+            ]
+            for title, section in [
+                ("Campaign Core", "campaign_core"),
+                ("Email Sequence", "email_sequence"),
+                ("Social Media", "social"),
+                ("Landing Page", "web_landing_page"),
+            ]:
+                parts += ["\n## ", title, "\n```json\n", section_strs[section], "\n```\n"]
 
----
+            if "audit" in st.session_state:
+                parts += ["\n\n---\n\n# Consistency Audit\n```json\n", st.session_state["audit_str"], "\n```\n"]
 
-# Consistency Audit
-```json
-{pretty_json(st.session_state["audit"])}
-```
-"""
+            export_md = "".join(parts)
+            st.session_state["_export_md"] = export_md
+            st.session_state["_export_sources"] = export_sources
+        export_md = st.session_state["_export_md"]
 
         # Display preview
         st.markdown("### Preview")
@@ -430,7 +1250,7 @@ Generated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
         st.download_button(
             label="📥 Download Campaign (.md)",
             data=export_md,
-            file_name=f"brand_campaign_{brand_name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
+            file_name=f"brand_campaign_{brand_name.lower().replace(' ', '_')}_{st.session_state['_generated_at'].strftime('%Y%m%d_%H%M%S')}.md",
             mime="text/markdown",
         )
     else: